@@ -1,145 +1,391 @@
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse
 import httpx
 import secrets
 import sqlite3
+import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
+from cachetools import TTLCache
 import hashlib
+import hmac
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 import os
 import json
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from urllib.parse import quote, quote_plus, urlencode
 
 app = FastAPI(
     title="Universal AI API",
     description="Multi-service AI API with credit limits and admin controls",
-    version="3.0.0"
+    version="3.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# Database initialization
-def init_db():
-    conn = sqlite3.connect('ai_api.db')
-    c = conn.cursor()
-    
-    # API keys table with credit limits
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            key TEXT UNIQUE NOT NULL,
-            name TEXT DEFAULT 'User Key',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1,
-            total_requests INTEGER DEFAULT 0,
-            daily_requests INTEGER DEFAULT 0,
-            daily_limit INTEGER DEFAULT 30,
-            credits INTEGER DEFAULT 30,
-            last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_used TIMESTAMP,
-            expires_at TIMESTAMP
-        )
-    ''')
-    
-    # Admin users table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS admin_users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    ''')
-    
-    # Request logs table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS request_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            api_key TEXT NOT NULL,
-            endpoint TEXT NOT NULL,
-            prompt TEXT,
-            response_time FLOAT,
-            credits_used INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (api_key) REFERENCES api_keys (key)
-        )
-    ''')
-    
-    # Insert default admin
-    password_hash = hashlib.sha256("mk123".encode()).hexdigest()
-    c.execute('''
-        INSERT OR IGNORE INTO admin_users (username, password_hash) 
-        VALUES (?, ?)
-    ''', ('mk', password_hash))
-    
-    conn.commit()
-    conn.close()
+# Database schema, created in a single transaction on startup
+SCHEMA = '''
+BEGIN;
+
+-- API keys table with credit limits
+CREATE TABLE IF NOT EXISTS api_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    name TEXT DEFAULT 'User Key',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT 1,
+    total_requests INTEGER DEFAULT 0,
+    daily_requests INTEGER DEFAULT 0,
+    daily_limit INTEGER DEFAULT 30,
+    credits INTEGER DEFAULT 30,
+    last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used TIMESTAMP,
+    expires_at TIMESTAMP
+);
+
+-- Admin users table
+CREATE TABLE IF NOT EXISTS admin_users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL
+);
+
+-- Request logs table
+CREATE TABLE IF NOT EXISTS request_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    api_key TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    prompt TEXT,
+    response_time FLOAT,
+    credits_used INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (api_key) REFERENCES api_keys (key)
+);
 
-init_db()
+-- Per-key usage lookups (api_keys.key is already indexed by its UNIQUE constraint)
+CREATE INDEX IF NOT EXISTS idx_logs_key_time ON request_logs (api_key, created_at);
+
+COMMIT;
+'''
+
+# Database initialization
+async def init_db():
+    async with get_conn() as conn:
+        await conn.executescript(SCHEMA)
+        
+        # Insert default admin, hashing its password only on first boot
+        cursor = await conn.execute(SQL_GET_ADMIN, ('mk',))
+        if await cursor.fetchone() is None:
+            password_hash = await asyncio.to_thread(PASSWORD_HASHER.hash, "mk123")
+            await conn.execute(
+                'INSERT OR IGNORE INTO admin_users (username, password_hash) VALUES (?, ?)',
+                ('mk', password_hash)
+            )
+            await conn.commit()
 
 # Utility functions
+PASSWORD_HASHER = PasswordHasher()
+
+# Checked against when the username is unknown, so a miss costs as much as a real login
+DUMMY_PASSWORD_HASH = PASSWORD_HASHER.hash(secrets.token_urlsafe(16))
+
 def generate_api_key():
     return f"api_{secrets.token_urlsafe(24)}"
 
-def get_db_connection():
-    conn = sqlite3.connect('ai_api.db')
-    conn.row_factory = sqlite3.Row
+def check_password(stored_hash: str, password: str) -> bool:
+    """Check a password against an argon2 hash or a legacy SHA-256 hex digest"""
+    if stored_hash.startswith('$argon2'):
+        try:
+            return PASSWORD_HASHER.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    # Pay the argon2 cost anyway so legacy rows don't reveal that the username exists
+    check_password(DUMMY_PASSWORD_HASH, password)
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_hash)
+
+# Hot-path SQL, kept as constants so each pooled connection's statement cache reuses them
+SQL_GET_ADMIN = 'SELECT password_hash FROM admin_users WHERE username = ?'
+SQL_GET_KEY = 'SELECT id, credits, is_active, daily_limit FROM api_keys WHERE key = ?'
+SQL_UPDATE_USAGE = '''UPDATE api_keys 
+    SET credits = credits - ?,
+        total_requests = total_requests + ?, 
+        daily_requests = daily_requests + ?,
+        last_used = CURRENT_TIMESTAMP 
+    WHERE key = ?'''
+SQL_INSERT_LOG = 'INSERT INTO request_logs (api_key, endpoint, prompt, response_time, credits_used, created_at) VALUES (?, ?, ?, ?, ?, ?)'
+
+# api_key -> {id, credits, is_active, daily_limit}; entries are dropped whenever admins change those columns
+KEY_CACHE = TTLCache(maxsize=4096, ttl=5)
+
+# Keys recently looked up and not found, so bogus keys cannot force a SELECT per request
+UNKNOWN_KEYS = TTLCache(maxsize=100000, ttl=5)
+
+# Per-key token buckets (tokens, last refill time), checked before any database work.
+# Idle buckets refill completely well within the TTL, so expiring them loses nothing.
+RATE_LIMIT_PER_SECOND = 10
+RATE_LIMIT_BURST = 20
+RATE_LIMIT_BUCKETS = TTLCache(maxsize=100000, ttl=60)
+
+# Credits and request counts accumulated in memory and flushed to api_keys periodically.
+# USAGE_LOCK is held while a flush is in flight so reads never miss pending deltas.
+USAGE_FLUSH_INTERVAL = 2.0
+CREDIT_DELTAS: Dict[str, int] = defaultdict(int)
+USAGE_DELTAS: Dict[str, int] = defaultdict(int)
+USAGE_LOCK = asyncio.Lock()
+usage_flush_count = 0  # bumped under USAGE_LOCK whenever a flush finishes
+usage_task: Optional[asyncio.Task] = None
+
+# Connection pool (created on startup)
+pool: Optional[SQLiteConnectionPool] = None
+
+# Request logs are queued and written in batches by a background task
+LOG_BATCH_SIZE = 500
+LOG_PROMPT_MAX_LENGTH = 512
+LOG_FLUSH_INTERVAL = 0.1
+LOG_QUEUE_MAX_SIZE = 10000
+LOG_QUEUE: Optional[asyncio.Queue] = None
+log_task: Optional[asyncio.Task] = None
+
+async def connection_factory():
+    """Open a new pooled database connection"""
+    # Twice sqlite3's default of 128, so every distinct query (including the
+    # per-connection PRAGMAs) stays compiled with plenty of headroom
+    conn = await aiosqlite.connect('ai_api.db', cached_statements=256)
+    conn.row_factory = aiosqlite.Row
+
+    # WAL lets readers and writers run concurrently; NORMAL skips the fsync per commit
+    await conn.execute('PRAGMA journal_mode=WAL')
+    await conn.execute('PRAGMA synchronous=NORMAL')
+    await conn.execute('PRAGMA temp_store=MEMORY')
+    await conn.execute('PRAGMA mmap_size=268435456')
+    await conn.execute('PRAGMA cache_size=-20000')
+    await conn.execute('PRAGMA busy_timeout=5000')
     return conn
 
-def verify_admin(username: str, password: str) -> bool:
-    conn = get_db_connection()
-    admin = conn.execute(
-        'SELECT password_hash FROM admin_users WHERE username = ?', 
-        (username,)
-    ).fetchone()
-    conn.close()
-    return admin and hashlib.sha256(password.encode()).hexdigest() == admin['password_hash']
-
-def check_credits(api_key: str, credits_needed: int = 0) -> bool:
-    """Check if user has enough credits"""
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT credits FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
+@app.on_event("startup")
+async def startup():
+    global pool, LOG_QUEUE, log_task, usage_task
+    pool = SQLiteConnectionPool(connection_factory)
+    await init_db()
+    LOG_QUEUE = asyncio.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+    log_task = asyncio.create_task(log_flusher())
+    usage_task = asyncio.create_task(usage_flusher())
+    
+    # Shared HTTP client so upstream calls reuse keep-alive connections
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        http2=True
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in (usage_task, log_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await flush_usage()
+    await pool.close()
+    await app.state.http.aclose()
+
+@asynccontextmanager
+async def get_conn():
+    """Borrow a connection from the pool"""
+    async with pool.connection() as conn:
+        yield conn
+
+async def write_logs(batch: List[tuple]):
+    """Insert a batch of request log rows"""
+    try:
+        async with get_conn() as conn:
+            await conn.executemany(SQL_INSERT_LOG, batch)
+            await conn.commit()
+    except Exception:
+        logging.exception("Failed to write %d request logs", len(batch))
+
+async def log_flusher():
+    """Drain LOG_QUEUE into request_logs, one transaction per batch"""
+    batch = []
+    writing = None
+    try:
+        while True:
+            batch.append(await LOG_QUEUE.get())
+            # Under load a full batch is already waiting; otherwise let stragglers join it
+            if LOG_QUEUE.qsize() < LOG_BATCH_SIZE - 1:
+                await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            while len(batch) < LOG_BATCH_SIZE and not LOG_QUEUE.empty():
+                batch.append(LOG_QUEUE.get_nowait())
+            pending, batch = batch, []
+            # Shielded so shutdown cannot roll back a batch that is already being written
+            writing = asyncio.create_task(write_logs(pending))
+            await asyncio.shield(writing)
+    except asyncio.CancelledError:
+        # Let an interrupted write commit, then flush whatever is still queued
+        if writing is not None:
+            await writing
+        while not LOG_QUEUE.empty():
+            batch.append(LOG_QUEUE.get_nowait())
+        if batch:
+            await write_logs(batch)
+        raise
+
+async def flush_usage():
+    """Apply accumulated credit and request deltas to api_keys in one transaction"""
+    global usage_flush_count
+    async with USAGE_LOCK:
+        if not USAGE_DELTAS and not CREDIT_DELTAS:
+            return
+        
+        credit_deltas, usage_deltas = dict(CREDIT_DELTAS), dict(USAGE_DELTAS)
+        CREDIT_DELTAS.clear()
+        USAGE_DELTAS.clear()
+        # Reservations for requests still in flight have credits but no request count yet
+        rows = [
+            (credit_deltas.get(key, 0), usage_deltas.get(key, 0), usage_deltas.get(key, 0), key)
+            for key in credit_deltas.keys() | usage_deltas.keys()
+        ]
+        
+        try:
+            async with get_conn() as conn:
+                await conn.executemany(SQL_UPDATE_USAGE, rows)
+                await conn.commit()
+        except Exception:
+            logging.exception("Failed to flush usage for %d keys", len(rows))
+            # Keep the deltas for the next attempt
+            for key, count in usage_deltas.items():
+                USAGE_DELTAS[key] += count
+            for key, credits in credit_deltas.items():
+                CREDIT_DELTAS[key] += credits
+        finally:
+            usage_flush_count += 1
+
+async def usage_flusher():
+    """Flush usage deltas every USAGE_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        # Shielded so shutdown cannot drop a batch that is already being written
+        await asyncio.shield(flush_usage())
+
+async def verify_admin(username: str, password: str) -> bool:
+    async with get_conn() as conn:
+        cursor = await conn.execute(SQL_GET_ADMIN, (username,))
+        admin = await cursor.fetchone()
+    
+    # argon2 is deliberately slow, so keep it off the event loop
+    if not admin:
+        await asyncio.to_thread(check_password, DUMMY_PASSWORD_HASH, password)
+        return False
+    
+    stored_hash = admin['password_hash']
+    if not await asyncio.to_thread(check_password, stored_hash, password):
         return False
     
-    has_credits = key_data['credits'] >= credits_needed
-    conn.close()
-    return has_credits
+    # Upgrade legacy SHA-256 hashes on successful login
+    if not stored_hash.startswith('$argon2'):
+        new_hash = await asyncio.to_thread(PASSWORD_HASHER.hash, password)
+        async with get_conn() as conn:
+            await conn.execute(
+                'UPDATE admin_users SET password_hash = ? WHERE username = ?',
+                (new_hash, username)
+            )
+            await conn.commit()
+    
+    return True
 
-def use_credits(api_key: str, credits_used: int):
-    """Deduct credits from user's balance"""
-    conn = get_db_connection()
-    conn.execute(
-        'UPDATE api_keys SET credits = credits - ? WHERE key = ?',
-        (credits_used, api_key)
-    )
-    conn.commit()
-    conn.close()
-
-def log_request(api_key: str, endpoint: str, prompt: str = None, response_time: float = None, credits_used: int = 0):
-    """Log API request for analytics"""
-    conn = get_db_connection()
-    conn.execute(
-        'INSERT INTO request_logs (api_key, endpoint, prompt, response_time, credits_used) VALUES (?, ?, ?, ?, ?)',
-        (api_key, endpoint, prompt, response_time, credits_used)
-    )
-    conn.commit()
-    conn.close()
-
-def update_usage(api_key: str):
-    """Update usage statistics"""
-    conn = get_db_connection()
-    conn.execute(
-        '''UPDATE api_keys 
-           SET total_requests = total_requests + 1, 
-               daily_requests = daily_requests + 1,
-               last_used = CURRENT_TIMESTAMP 
-           WHERE key = ?''',
-        (api_key,)
-    )
-    conn.commit()
-    conn.close()
+def check_rate_limit(api_key: str):
+    """Take a token from the key's bucket or reject the request with 429"""
+    now = time.monotonic()
+    tokens, last_refill = RATE_LIMIT_BUCKETS.get(api_key, (RATE_LIMIT_BURST, now))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last_refill) * RATE_LIMIT_PER_SECOND)
+    
+    if tokens < 1:
+        RATE_LIMIT_BUCKETS[api_key] = (tokens, now)
+        raise HTTPException(status_code=429, detail="Rate limit exceeded. Please slow down.")
+    
+    RATE_LIMIT_BUCKETS[api_key] = (tokens - 1, now)
+
+async def load_key(api_key: str) -> Optional[dict]:
+    """Read a key from the database and cache it, net of unflushed credit deltas"""
+    while True:
+        flush_count = usage_flush_count
+        # Read outside USAGE_LOCK so lookups never queue behind a flush
+        async with get_conn() as conn:
+            cursor = await conn.execute(SQL_GET_KEY, (api_key,))
+            row = await cursor.fetchone()
+        
+        async with USAGE_LOCK:
+            if usage_flush_count != flush_count:
+                # A flush landed during the read, so the row may or may not include it
+                continue
+            
+            if row is None:
+                UNKNOWN_KEYS[api_key] = True
+                return None
+            
+            # Another request may have cached the key meanwhile; share its balance
+            key_data = KEY_CACHE.get(api_key)
+            if key_data is None:
+                # The stored balance does not include deductions that are not flushed yet
+                key_data = dict(row)
+                key_data['credits'] -= CREDIT_DELTAS.get(api_key, 0)
+                KEY_CACHE[api_key] = key_data
+            return key_data
+
+async def validate_api_key(api_key: str, credits_needed: int = 0):
+    """Validate the API key and check it has enough credits"""
+    check_rate_limit(api_key)
+    
+    if api_key in UNKNOWN_KEYS:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    
+    key_data = KEY_CACHE.get(api_key)
+    if key_data is None:
+        key_data = await load_key(api_key)
+    
+    if not key_data or not key_data['is_active']:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    
+    if key_data['credits'] < credits_needed:
+        unit = "credit" if credits_needed == 1 else "credits"
+        raise HTTPException(status_code=402, detail=f"Insufficient credits. This service costs {credits_needed} {unit}.")
+    
+    # Reserve the credits now, with no await since the check, so concurrent
+    # requests on one key cannot all pass the check and overdraw it
+    if credits_needed:
+        key_data['credits'] -= credits_needed
+        CREDIT_DELTAS[api_key] += credits_needed
+    
+    return key_data
+
+def refund_credits(api_key: str, credits: int):
+    """Give back credits reserved by validate_api_key when the request fails"""
+    CREDIT_DELTAS[api_key] -= credits
+    key_data = KEY_CACHE.get(api_key)
+    if key_data is not None:
+        key_data['credits'] += credits
+
+def finalize_request(api_key: str, endpoint: str, prompt: str = None, response_time: float = None, credits_used: int = 0):
+    """Update usage statistics and queue the request log (credits were reserved up front)"""
+    USAGE_DELTAS[api_key] += 1
+    
+    # Only a prefix of the prompt is kept so request_logs stays small
+    if prompt:
+        prompt = prompt[:LOG_PROMPT_MAX_LENGTH]
+    
+    # Timestamped here rather than by the column default, since rows may wait in the queue
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        LOG_QUEUE.put_nowait((api_key, endpoint, prompt, response_time, credits_used, created_at))
+    except asyncio.QueueFull:
+        # Drop the log rather than let the backlog grow without bound
+        pass
 
 # API Routes
 @app.get("/")
@@ -153,61 +399,49 @@ async def ffinfo_redirect(
     api_key: str = Query(..., description="Your API key")
 ):
     """Redirect to danger info service - COST: 1 credit per request"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    # Check if user has enough credits (1 credit needed)
-    if not check_credits(api_key, 1):
-        raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
-    
-    # Validate API key
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    # Validate API key and reserve credits (1 credit needed)
+    await validate_api_key(api_key, 1)
     
     # Replace the dangerous text with developer info
-    redirect_url = f"https://danger-info-alpha.vercel.app/accinfo?uid={uid}&key=MK_DEVELOPER"
+    redirect_url = f"https://danger-info-alpha.vercel.app/accinfo?uid={quote(uid, safe='')}&key=MK_DEVELOPER"
     
-    # Deduct credits and log request
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    use_credits(api_key, 1)
-    update_usage(api_key)
-    log_request(api_key, "/ffinfo", f"uid={uid}", response_time, 1)
+    # Update usage and log request
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/ffinfo", f"uid={uid}", response_time, 1)
     
-    return RedirectResponse(redirect_url)
+    return RedirectResponse(redirect_url, status_code=307)
 
 @app.get("/api_key")
 async def check_api_usage(api_key: str = Query(..., description="Your API key")):
     """Check API key usage and credits"""
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ?',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
-    
-    # Get today's usage from logs
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    today_requests = conn.execute(
-        'SELECT COUNT(*) FROM request_logs WHERE api_key = ? AND created_at >= ?',
-        (api_key, today_start)
-    ).fetchone()[0]
-    
-    # Get total credits used
-    total_credits_used = conn.execute(
-        'SELECT SUM(credits_used) FROM request_logs WHERE api_key = ?',
-        (api_key,)
-    ).fetchone()[0] or 0
-    
-    conn.close()
+    check_rate_limit(api_key)
+    
+    async with get_conn() as conn:
+        cursor = await conn.execute(
+            'SELECT * FROM api_keys WHERE key = ?',
+            (api_key,)
+        )
+        key_data = await cursor.fetchone()
+        
+        if not key_data:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        # Get today's usage from logs
+        today_start = datetime.utcnow().strftime("%Y-%m-%d 00:00:00")
+        cursor = await conn.execute(
+            'SELECT COUNT(*) FROM request_logs WHERE api_key = ? AND created_at >= ?',
+            (api_key, today_start)
+        )
+        today_requests = (await cursor.fetchone())[0]
+        
+        # Get total credits used
+        cursor = await conn.execute(
+            'SELECT SUM(credits_used) FROM request_logs WHERE api_key = ?',
+            (api_key,)
+        )
+        total_credits_used = (await cursor.fetchone())[0] or 0
     
     return {
         "api_key": f"{api_key[:8]}...{api_key[-4:]}",
@@ -220,7 +454,7 @@ async def check_api_usage(api_key: str = Query(..., description="Your API key"))
             "remaining_today": max(0, key_data['daily_limit'] - today_requests)
         },
         "credits": {
-            "available": key_data['credits'],
+            "available": key_data['credits'] - CREDIT_DELTAS.get(api_key, 0),
             "total_used": total_credits_used
         },
         "created_at": key_data['created_at'],
@@ -234,34 +468,25 @@ async def text_generation(
     api_key: str = Query(..., description="Your API key")
 ):
     """Text generation using Pollinations.ai - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     # Validate API key
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    await validate_api_key(api_key)
     
     # Call Pollinations.ai
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            pollinations_url = f"https://text.pollinations.ai/prompt/{prompt}"
-            response = await client.get(pollinations_url)
-            response.raise_for_status()
-            ai_response = response.text
-            
+        client = app.state.http
+        pollinations_url = "https://text.pollinations.ai/prompt/" + quote(prompt, safe="")
+        response = await client.get(pollinations_url)
+        response.raise_for_status()
+        ai_response = response.text
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
     
     # Update usage and log request (0 credits)
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    update_usage(api_key)
-    log_request(api_key, "/text", prompt, response_time, 0)
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/text", prompt, response_time, 0)
     
     # Return ONLY the AI response
     return ai_response
@@ -274,40 +499,18 @@ async def image_generation(
     height: int = Query(512, description="Image height")
 ):
     """Image generation using Pollinations.ai - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     # Validate API key
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    await validate_api_key(api_key)
     
-    # Call Pollinations.ai Image API
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            pollinations_url = f"https://image.pollinations.ai/prompt/{prompt}"
-            params = {"width": width, "height": height}
-            response = await client.get(pollinations_url, params=params)
-            response.raise_for_status()
-            
-            # Return direct image URL
-            direct_image_url = f"https://image.pollinations.ai/prompt/{prompt}?width={width}&height={height}&nologo=true"
-            
-            # Return the image URL directly for immediate display
-            return direct_image_url
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Image service error: {str(e)}")
+    # Return direct image URL (Pollinations generates the image when it is fetched)
+    query = urlencode({"width": width, "height": height, "nologo": "true"})
+    direct_image_url = f"https://image.pollinations.ai/prompt/{quote(prompt, safe='')}?{query}"
     
     # Update usage and log request (0 credits)
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    update_usage(api_key)
-    log_request(api_key, "/image", prompt, response_time, 0)
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/image", prompt, response_time, 0)
     
     return direct_image_url
 
@@ -318,42 +521,23 @@ async def qr_generation(
     size: str = Query("150x150", description="QR code size")
 ):
     """QR code generation - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     # Validate API key
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
-    # Call QR code API
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size={size}&data={text}"
-            response = await client.get(qr_url)
-            response.raise_for_status()
-            
-            # Return QR code information with direct URL
-            direct_qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size={size}&data={text}"
-            qr_response = {
-                "qr_code_url": direct_qr_url,
-                "text": text,
-                "size": size,
-                "note": "Visit the URL to see/download your QR code"
-            }
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"QR code service error: {str(e)}")
+    await validate_api_key(api_key)
+    
+    # Return QR code information with direct URL
+    direct_qr_url = "https://api.qrserver.com/v1/create-qr-code/?" + urlencode({"size": size, "data": text})
+    qr_response = {
+        "qr_code_url": direct_qr_url,
+        "text": text,
+        "size": size,
+        "note": "Visit the URL to see/download your QR code"
+    }
     
     # Update usage and log request (0 credits)
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    update_usage(api_key)
-    log_request(api_key, "/qr", text, response_time, 0)
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/qr", text, response_time, 0)
     
     return qr_response
 
@@ -364,34 +548,17 @@ async def voice_generation(
     voice: str = Query("alloy", description="Voice type")
 ):
     """Text-to-speech generation - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     # Validate API key
-    conn = get_db_connection()
-    key_data = conn.execute(
-        'SELECT * FROM api_keys WHERE key = ? AND is_active = 1',
-        (api_key,)
-    ).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    await validate_api_key(api_key)
     
-    # Call text-to-speech API
-    try:
-        # Return direct voice URL
-        voice_url = f"https://api.soundoftext.com/sounds/{text.lower().replace(' ', '+')}?voice={voice}"
-        
-        # Return the direct voice URL for immediate access
-        return voice_url
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Voice service error: {str(e)}")
+    # Return direct voice URL
+    voice_url = f"https://api.soundoftext.com/sounds/{quote_plus(text.lower())}?{urlencode({'voice': voice})}"
     
     # Update usage and log request (0 credits)
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    update_usage(api_key)
-    log_request(api_key, "/voice", text, response_time, 0)
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/voice", text, response_time, 0)
     
     return voice_url
 
@@ -402,28 +569,26 @@ async def number_service(
     api_key: str = Query(..., description="Your API key")
 ):
     """Number service - COST: 5 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    # Check if user has enough credits (5 credits needed)
-    if not check_credits(api_key, 5):
-        raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 5 credits.")
+    # Validate API key and reserve credits (5 credits needed)
+    await validate_api_key(api_key, 5)
     
     # Call number service API
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            num_url = f"https://nixonsmmapi.s77134867.workers.dev/?mobile={mobile}"
-            response = await client.get(num_url)
-            response.raise_for_status()
-            num_response = response.text
-            
+        client = app.state.http
+        num_url = "https://nixonsmmapi.s77134867.workers.dev/"
+        response = await client.get(num_url, params={"mobile": mobile})
+        response.raise_for_status()
+        num_response = response.text
+        
     except Exception as e:
+        refund_credits(api_key, 5)
         raise HTTPException(status_code=500, detail=f"Number service error: {str(e)}")
     
-    # Deduct credits and log request
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    use_credits(api_key, 5)
-    update_usage(api_key)
-    log_request(api_key, "/num", mobile, response_time, 5)
+    # Update usage and log request
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/num", mobile, response_time, 5)
     
     return num_response
 
@@ -433,28 +598,26 @@ async def video_generation(
     api_key: str = Query(..., description="Your API key")
 ):
     """Video generation - COST: 2 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    # Check if user has enough credits (2 credits needed)
-    if not check_credits(api_key, 2):
-        raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 2 credits.")
+    # Validate API key and reserve credits (2 credits needed)
+    await validate_api_key(api_key, 2)
     
     # Call video generation API
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            video_url = f"https://api.yabes-desu.workers.dev/ai/tool/txt2video?prompt={prompt}"
-            response = await client.get(video_url)
-            response.raise_for_status()
-            video_response = response.json()
-            
+        client = app.state.http
+        video_url = "https://api.yabes-desu.workers.dev/ai/tool/txt2video"
+        response = await client.get(video_url, params={"prompt": prompt}, timeout=60.0)
+        response.raise_for_status()
+        video_response = response.json()
+        
     except Exception as e:
+        refund_credits(api_key, 2)
         raise HTTPException(status_code=500, detail=f"Video service error: {str(e)}")
     
-    # Deduct credits and log request
-    response_time = (datetime.utcnow() - start_time).total_seconds()
-    use_credits(api_key, 2)
-    update_usage(api_key)
-    log_request(api_key, "/video", prompt, response_time, 2)
+    # Update usage and log request
+    response_time = time.perf_counter() - start_time
+    finalize_request(api_key, "/video", prompt, response_time, 2)
     
     # Process video response to match the desired format
     if isinstance(video_response, dict):
@@ -498,24 +661,23 @@ async def admin_generate_key(
     initial_credits: int = Query(30, description="Initial credits")
 ):
     """Admin: Generate new API key"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
     new_key = generate_api_key()
     expires_at = datetime.utcnow() + timedelta(days=365)
     
-    conn = get_db_connection()
-    try:
-        conn.execute(
-            'INSERT INTO api_keys (key, name, daily_limit, credits, expires_at) VALUES (?, ?, ?, ?, ?)',
-            (new_key, key_name, daily_limit, initial_credits, expires_at)
-        )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Key generation failed")
+    async with get_conn() as conn:
+        try:
+            await conn.execute(
+                'INSERT INTO api_keys (key, name, daily_limit, credits, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (new_key, key_name, daily_limit, initial_credits, expires_at)
+            )
+            await conn.commit()
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=400, detail="Key generation failed")
     
-    conn.close()
+    UNKNOWN_KEYS.pop(new_key, None)
     
     return {
         "success": True,
@@ -532,44 +694,45 @@ async def admin_list_keys(
     admin_password: str = Query(..., description="Admin password")
 ):
     """Admin: List all API keys with detailed information"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    keys = conn.execute('SELECT * FROM api_keys ORDER BY created_at DESC').fetchall()
-    
-    # Get detailed statistics
-    keys_with_stats = []
-    for key in keys:
-        # Get today's usage
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_requests = conn.execute(
-            'SELECT COUNT(*) FROM request_logs WHERE api_key = ? AND created_at >= ?',
-            (key['key'], today_start)
-        ).fetchone()[0]
-        
-        # Get total credits used
-        total_credits_used = conn.execute(
-            'SELECT SUM(credits_used) FROM request_logs WHERE api_key = ?',
-            (key['key'],)
-        ).fetchone()[0] or 0
-        
-        keys_with_stats.append({
-            "id": key['id'],
-            "name": key['name'],
-            "key": key['key'],
-            "is_active": bool(key['is_active']),
-            "total_requests": key['total_requests'],
-            "daily_used": today_requests,
-            "daily_limit": key['daily_limit'],
-            "credits_available": key['credits'],
-            "credits_used": total_credits_used,
-            "created_at": key['created_at'],
-            "last_used": key['last_used'],
-            "expires_at": key['expires_at']
-        })
-    
-    conn.close()
+    async with get_conn() as conn:
+        # Get keys together with today's usage and total credits used,
+        # with columns named after the response fields
+        today_start = datetime.utcnow().strftime("%Y-%m-%d 00:00:00")
+        cursor = await conn.execute('''
+            SELECT k.id,
+                   k.name,
+                   k.key,
+                   k.is_active,
+                   k.total_requests,
+                   COALESCE(t.today_cnt, 0) AS daily_used,
+                   k.daily_limit,
+                   k.credits AS credits_available,
+                   COALESCE(t.credits_used, 0) AS credits_used,
+                   k.created_at,
+                   k.last_used,
+                   k.expires_at
+            FROM api_keys k
+            LEFT JOIN (
+                SELECT api_key,
+                       SUM(CASE WHEN created_at >= ? THEN 1 ELSE 0 END) AS today_cnt,
+                       SUM(credits_used) AS credits_used
+                FROM request_logs
+                GROUP BY api_key
+            ) t ON t.api_key = k.key
+            ORDER BY k.created_at DESC
+        ''', (today_start,))
+        # Balances net of reserved and unflushed credits, as validate_api_key sees them
+        keys_with_stats = [
+            dict(
+                row,
+                is_active=bool(row['is_active']),
+                credits_available=row['credits_available'] - CREDIT_DELTAS.get(row['key'], 0)
+            )
+            for row in await cursor.fetchall()
+        ]
     
     return {
         "total_keys": len(keys_with_stats),
@@ -584,22 +747,23 @@ async def admin_increase_limit(
     new_limit: int = Query(50, description="New daily limit")
 ):
     """Admin: Increase daily limit for an API key"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    key_data = conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,)).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
+    async with get_conn() as conn:
+        cursor = await conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,))
+        key_data = await cursor.fetchone()
+        
+        if not key_data:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        await conn.execute(
+            'UPDATE api_keys SET daily_limit = ? WHERE key = ?',
+            (new_limit, api_key)
+        )
+        await conn.commit()
     
-    conn.execute(
-        'UPDATE api_keys SET daily_limit = ? WHERE key = ?',
-        (new_limit, api_key)
-    )
-    conn.commit()
-    conn.close()
+    KEY_CACHE.pop(api_key, None)
     
     return {
         "success": True,
@@ -615,27 +779,28 @@ async def admin_add_credits(
     credits_to_add: int = Query(10, description="Credits to add")
 ):
     """Admin: Add credits to an API key"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    key_data = conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,)).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
+    async with get_conn() as conn:
+        cursor = await conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,))
+        key_data = await cursor.fetchone()
+        
+        if not key_data:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        await conn.execute(
+            'UPDATE api_keys SET credits = credits + ? WHERE key = ?',
+            (credits_to_add, api_key)
+        )
+        await conn.commit()
     
-    conn.execute(
-        'UPDATE api_keys SET credits = credits + ? WHERE key = ?',
-        (credits_to_add, api_key)
-    )
-    conn.commit()
-    conn.close()
+    KEY_CACHE.pop(api_key, None)
     
     return {
         "success": True,
         "message": f"Added {credits_to_add} credits to key {api_key[:8]}...",
-        "new_credit_balance": key_data['credits'] + credits_to_add
+        "new_credit_balance": key_data['credits'] - CREDIT_DELTAS.get(api_key, 0) + credits_to_add
     }
 
 @app.get("/admin/resetapilimit")
@@ -645,22 +810,21 @@ async def admin_reset_limit(
     api_key: str = Query(..., description="API key to reset")
 ):
     """Admin: Reset daily usage counter"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    key_data = conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,)).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
-    
-    conn.execute(
-        'UPDATE api_keys SET daily_requests = 0, last_reset = CURRENT_TIMESTAMP WHERE key = ?',
-        (api_key,)
-    )
-    conn.commit()
-    conn.close()
+    async with get_conn() as conn:
+        cursor = await conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,))
+        key_data = await cursor.fetchone()
+        
+        if not key_data:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        await conn.execute(
+            'UPDATE api_keys SET daily_requests = 0, last_reset = CURRENT_TIMESTAMP WHERE key = ?',
+            (api_key,)
+        )
+        await conn.commit()
     
     return {
         "success": True,
@@ -675,22 +839,25 @@ async def admin_delete_key(
     api_key: str = Query(..., description="API key to delete")
 ):
     """Admin: Delete an API key"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    key_data = conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,)).fetchone()
-    
-    if not key_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
+    async with get_conn() as conn:
+        cursor = await conn.execute('SELECT * FROM api_keys WHERE key = ?', (api_key,))
+        key_data = await cursor.fetchone()
+        
+        if not key_data:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        # Delete associated logs first
+        await conn.execute('DELETE FROM request_logs WHERE api_key = ?', (api_key,))
+        # Delete the key
+        await conn.execute('DELETE FROM api_keys WHERE key = ?', (api_key,))
+        await conn.commit()
     
-    # Delete associated logs first
-    conn.execute('DELETE FROM request_logs WHERE api_key = ?', (api_key,))
-    # Delete the key
-    conn.execute('DELETE FROM api_keys WHERE key = ?', (api_key,))
-    conn.commit()
-    conn.close()
+    KEY_CACHE.pop(api_key, None)
+    CREDIT_DELTAS.pop(api_key, None)
+    USAGE_DELTAS.pop(api_key, None)
     
     return {
         "success": True,
@@ -705,35 +872,37 @@ async def admin_stats(
     admin_password: str = Query(..., description="Admin password")
 ):
     """Admin: Overall system statistics"""
-    if not verify_admin(admin_username, admin_password):
+    if not await verify_admin(admin_username, admin_password):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    conn = get_db_connection()
-    
-    # Basic stats
-    total_keys = conn.execute('SELECT COUNT(*) FROM api_keys').fetchone()[0]
-    active_keys = conn.execute('SELECT COUNT(*) FROM api_keys WHERE is_active = 1').fetchone()[0]
-    total_requests = conn.execute('SELECT SUM(total_requests) FROM api_keys').fetchone()[0] or 0
-    total_credits_used = conn.execute('SELECT SUM(credits_used) FROM request_logs').fetchone()[0] or 0
-    
-    # Today's stats
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    today_requests = conn.execute(
-        'SELECT COUNT(*) FROM request_logs WHERE created_at >= ?',
-        (today_start,)
-    ).fetchone()[0]
-    
-    # Top users
-    top_users = conn.execute('''
-        SELECT api_key, COUNT(*) as request_count 
-        FROM request_logs 
-        WHERE created_at >= ? 
-        GROUP BY api_key 
-        ORDER BY request_count DESC 
-        LIMIT 5
-    ''', (today_start,)).fetchall()
-    
-    conn.close()
+    async with get_conn() as conn:
+        # Basic stats
+        cursor = await conn.execute('SELECT COUNT(*) FROM api_keys')
+        total_keys = (await cursor.fetchone())[0]
+        cursor = await conn.execute('SELECT COUNT(*) FROM api_keys WHERE is_active = 1')
+        active_keys = (await cursor.fetchone())[0]
+        cursor = await conn.execute('SELECT SUM(total_requests) FROM api_keys')
+        total_requests = (await cursor.fetchone())[0] or 0
+        cursor = await conn.execute('SELECT SUM(credits_used) FROM request_logs')
+        total_credits_used = (await cursor.fetchone())[0] or 0
+        
+        # Today's stats
+        today_start = datetime.utcnow().strftime("%Y-%m-%d 00:00:00")
+        cursor = await conn.execute(
+            'SELECT COUNT(*) FROM request_logs WHERE created_at >= ?',
+            (today_start,)
+        )
+        today_requests = (await cursor.fetchone())[0]
+        
+        # Top users
+        top_users = await conn.execute_fetchall('''
+            SELECT api_key, COUNT(*) as request_count 
+            FROM request_logs 
+            WHERE created_at >= ? 
+            GROUP BY api_key 
+            ORDER BY request_count DESC 
+            LIMIT 5
+        ''', (today_start,))
     
     return {
         "system_stats": {
@@ -752,9 +921,19 @@ async def admin_stats(
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return ORJSONResponse({"status": "healthy", "timestamp": datetime.utcnow().isoformat()})
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Key cache and usage deltas are per process, so keep WORKERS at 1 unless
+    # slightly stale cross-worker credit checks are acceptable
+    uvicorn.run(
+        "Render_app:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        workers=int(os.environ.get("WORKERS", 1))
+    )
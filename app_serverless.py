@@ -1,53 +1,137 @@
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, ORJSONResponse, Response
 import httpx
+import orjson
 import secrets
 import hashlib
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+import hmac
+from datetime import datetime, timedelta, timezone, date
+from typing import NamedTuple
+from dataclasses import dataclass
 import os
 import json
+import re
+import time
 import asyncio
+import itertools
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from heapq import nlargest
+from operator import itemgetter
+from urllib.parse import quote, quote_plus
+
+async def _log_consumer():
+    """Move queued log records into the bounded log buffer"""
+    while True:
+        rec = await LOG_QUEUE.get()
+        REQUEST_LOGS_STORAGE.append(rec)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per container boot rather than on every import
+    init_storage()
+    log_consumer = asyncio.create_task(_log_consumer())
+    # Shared HTTP client so upstream calls reuse keep-alive connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200)
+    )
+    yield
+    await app.state.http.aclose()
+    log_consumer.cancel()
 
 app = FastAPI(
     title="Universal AI API",
     description="Multi-service AI API with credit limits and admin controls",
-    version="3.0.0"
+    version="3.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+class LogRec(NamedTuple):
+    """A single request log entry"""
+    id: int
+    api_key: str
+    endpoint: str
+    prompt: str | None
+    response_time: float | None
+    credits_used: int
+    created_at: float  # UTC epoch seconds
+
+@dataclass(slots=True)
+class KeyRec:
+    """An API key and its usage counters"""
+    id: int
+    key: str
+    name: str
+    created_at: datetime
+    expires_at: datetime
+    daily_limit: int
+    credits: int
+    is_active: bool = True
+    total_requests: int = 0
+    daily_requests: int = 0
+    last_reset: datetime | None = None
+    last_used: datetime | None = None
+    credits_used_total: int = 0
+    today_date: date | None = None
+    today_count: int = 0
+
 # In-memory storage for serverless compatibility
-API_KEYS_STORAGE = {}
+API_KEYS_STORAGE: dict[str, KeyRec] = {}
 ADMIN_USERS_STORAGE = {}
-REQUEST_LOGS_STORAGE = []
+REQUEST_LOGS_STORAGE = deque(maxlen=1000)  # oldest logs are evicted automatically
+LOG_QUEUE = asyncio.Queue(maxsize=10000)
+DAILY_REQUESTS = defaultdict(int)  # UTC date -> requests across all keys
+
+# Monotonic ids; never reused after eviction or deletion
+_next_log_id = itertools.count(1)
+_next_key_id = itertools.count(1)
+
+# Upstream service URLs
+_FFINFO_PREFIX = "https://danger-info-alpha.vercel.app/accinfo?uid="
+_FFINFO_SUFFIX = "&key=MK_DEVELOPER"
+TEXT_URL = "https://text.pollinations.ai/prompt/"
+IMAGE_URL = "https://image.pollinations.ai/prompt/"
+QR_URL = "https://api.qrserver.com/v1/create-qr-code/"
+VOICE_URL = "https://api.soundoftext.com/sounds/"
+NUM_URL = "https://nixonsmmapi.s77134867.workers.dev/"
+VIDEO_URL = "https://api.yabes-desu.workers.dev/ai/tool/txt2video"
+
+# Accepted shapes for identifiers forwarded to upstream services
+_MOBILE_RE = re.compile(r'\+?\d{6,15}')
+_UID_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Longest prompt/text accepted by the free endpoints
+PROMPT_MAX_LENGTH = 2048
+
+# Recent /text responses, kept for the life of the container
+TEXT_CACHE_TTL = 300
+TEXT_CACHE_MAX_SIZE = 512
+TEXT_CACHE: dict[bytes, tuple[float, str]] = {}  # blake2b(prompt) -> (stored_at, response)
 
 # Initialize storage with default admin
 def init_storage():
     """Initialize in-memory storage for serverless environment"""
     global API_KEYS_STORAGE, ADMIN_USERS_STORAGE, REQUEST_LOGS_STORAGE
     
-    # Default admin
-    password_hash = hashlib.sha256("mk123".encode()).hexdigest()
-    ADMIN_USERS_STORAGE['mk'] = password_hash
+    # Default admin (raw SHA-256 digest)
+    ADMIN_USERS_STORAGE['mk'] = hashlib.sha256(b"mk123").digest()
     
     # Create a default API key for testing
+    now = datetime.now(timezone.utc)
     default_key = generate_api_key()
-    API_KEYS_STORAGE[default_key] = {
-        'id': 1,
-        'key': default_key,
-        'name': 'Test Key',
-        'created_at': datetime.utcnow(),
-        'is_active': True,
-        'total_requests': 0,
-        'daily_requests': 0,
-        'daily_limit': 30,
-        'credits': 50,  # Give more credits for testing
-        'last_reset': datetime.utcnow(),
-        'last_used': None,
-        'expires_at': datetime.utcnow() + timedelta(days=365)
-    }
-
-# Initialize on import
-init_storage()
+    API_KEYS_STORAGE[default_key] = KeyRec(
+        id=next(_next_key_id),
+        key=default_key,
+        name='Test Key',
+        created_at=now,
+        expires_at=now + timedelta(days=365),
+        daily_limit=30,
+        credits=50,  # Give more credits for testing
+        last_reset=now
+    )
 
 # Utility functions
 def generate_api_key():
@@ -55,56 +139,81 @@ def generate_api_key():
 
 def verify_admin(username: str, password: str) -> bool:
     """Verify admin credentials"""
-    if username in ADMIN_USERS_STORAGE:
-        stored_hash = ADMIN_USERS_STORAGE[username]
-        return hashlib.sha256(password.encode()).hexdigest() == stored_hash
-    return False
-
-def check_credits(api_key: str, credits_needed: int = 0) -> bool:
-    """Check if user has enough credits"""
-    if api_key not in API_KEYS_STORAGE:
+    password_hash = hashlib.sha256(password.encode()).digest()
+    return hmac.compare_digest(password_hash, ADMIN_USERS_STORAGE.get(username, b''))
+
+def try_consume(key_data: KeyRec, credits_needed: int) -> bool:
+    """Deduct credits if the key is active and can afford them.
+
+    The check and the deduction run with no await in between, so two
+    concurrent requests on one key cannot both spend the last credits.
+    """
+    if not key_data.is_active or key_data.credits < credits_needed:
         return False
+    key_data.credits -= credits_needed
+    return True
+
+def refund_credits(key_data: KeyRec, credits: int):
+    """Give back credits taken by try_consume when the upstream call fails"""
+    key_data.credits += credits
+
+def log_request(key_data: KeyRec, endpoint: str, prompt: str | None = None, response_time: float | None = None, credits_used: int = 0, now: datetime | None = None):
+    """Queue API request log for analytics and update usage counters"""
+    now = now or datetime.now(timezone.utc)
+    today = now.date()
+    DAILY_REQUESTS[today] += 1
     
-    key_data = API_KEYS_STORAGE[api_key]
-    if not key_data['is_active']:
-        return False
+    key_data.credits_used_total += credits_used
+    if key_data.today_date != today:
+        key_data.today_date = today
+        key_data.today_count = 0
+    key_data.today_count += 1
     
-    return key_data['credits'] >= credits_needed
-
-def use_credits(api_key: str, credits_used: int):
-    """Deduct credits from user's balance"""
-    if api_key in API_KEYS_STORAGE:
-        API_KEYS_STORAGE[api_key]['credits'] -= credits_used
-
-def log_request(api_key: str, endpoint: str, prompt: str = None, response_time: float = None, credits_used: int = 0):
-    """Log API request for analytics"""
-    REQUEST_LOGS_STORAGE.append({
-        'id': len(REQUEST_LOGS_STORAGE) + 1,
-        'api_key': api_key,
-        'endpoint': endpoint,
-        'prompt': prompt,
-        'response_time': response_time,
-        'credits_used': credits_used,
-        'created_at': datetime.utcnow()
-    })
+    rec = LogRec(
+        id=next(_next_log_id),
+        api_key=key_data.key,
+        endpoint=endpoint,
+        prompt=prompt,
+        response_time=response_time,
+        credits_used=credits_used,
+        created_at=now.timestamp()
+    )
     
-    # Keep only last 1000 logs to prevent memory issues
-    if len(REQUEST_LOGS_STORAGE) > 1000:
-        REQUEST_LOGS_STORAGE.pop(0)
+    try:
+        LOG_QUEUE.put_nowait(rec)
+    except asyncio.QueueFull:
+        # Drop the log rather than block the request
+        pass
+
+def validate_prompt(prompt: str):
+    """Reject empty or oversized input before any upstream work"""
+    if not prompt.strip():
+        raise HTTPException(status_code=400, detail="Empty prompt")
+    if len(prompt) > PROMPT_MAX_LENGTH:
+        raise HTTPException(status_code=413, detail=f"Prompt too long (max {PROMPT_MAX_LENGTH} characters)")
+
+def get_today_count(key_data: KeyRec, today: date) -> int:
+    """Requests made by a key on the given UTC date"""
+    return key_data.today_count if key_data.today_date == today else 0
 
-def update_usage(api_key: str):
+def _cached_redirect(url: str) -> RedirectResponse:
+    """307 to a generated URL; these URLs are pure functions of their inputs"""
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": "max-age=3600"})
+
+def update_usage(key_data: KeyRec, now: datetime):
     """Update usage statistics"""
-    if api_key in API_KEYS_STORAGE:
-        key_data = API_KEYS_STORAGE[api_key]
-        key_data['total_requests'] += 1
-        key_data['daily_requests'] += 1
-        key_data['last_used'] = datetime.utcnow()
+    key_data.total_requests += 1
+    key_data.daily_requests += 1
+    key_data.last_used = now
 
 # API Routes
+# Never mutated after construction, so one instance serves every hit
+_DOCS_REDIRECT = RedirectResponse(url="/docs", status_code=307)
+
 @app.get("/")
 async def root():
     """Redirect to API documentation"""
-    return RedirectResponse("/docs")
+    return _DOCS_REDIRECT
 
 @app.get("/ffinfo")
 async def ffinfo_redirect(
@@ -112,25 +221,29 @@ async def ffinfo_redirect(
     api_key: str = Query(..., description="Your API key")
 ):
     """Redirect to danger info service - COST: 1 credit per request"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
-        # Check if user has enough credits (1 credit needed)
-        if not check_credits(api_key, 1):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
-        
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
+        if not _UID_RE.fullmatch(uid):
+            raise HTTPException(status_code=400, detail="Invalid uid")
+        
+        # Deduct credits (1 credit needed)
+        if not try_consume(key_data, 1):
+            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
+        
         # Replace the dangerous text with developer info
-        redirect_url = f"https://danger-info-alpha.vercel.app/accinfo?uid={uid}&key=MK_DEVELOPER"
+        redirect_url = _FFINFO_PREFIX + quote(uid, safe='') + _FFINFO_SUFFIX
         
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 1)
-        update_usage(api_key)
-        log_request(api_key, "/ffinfo", f"uid={uid}", response_time, 1)
+        # Log request
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/ffinfo", f"uid={uid}", response_time, 1, now)
         
         return RedirectResponse(redirect_url)
         
@@ -143,35 +256,29 @@ async def ffinfo_redirect(
 async def check_api_usage(api_key: str = Query(..., description="Your API key")):
     """Check API key usage and credits"""
     try:
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=404, detail="API key not found")
         
-        key_data = API_KEYS_STORAGE[api_key]
-        
-        # Get today's usage from logs
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_requests = sum(1 for log in REQUEST_LOGS_STORAGE 
-                           if log['api_key'] == api_key and log['created_at'] >= today_start)
-        
-        # Get total credits used
-        total_credits_used = sum(log['credits_used'] for log in REQUEST_LOGS_STORAGE if log['api_key'] == api_key)
+        today_requests = get_today_count(key_data, datetime.now(timezone.utc).date())
+        total_credits_used = key_data.credits_used_total
         
         return {
             "api_key": f"{api_key[:8]}...{api_key[-4:]}",
-            "name": key_data['name'],
-            "is_active": key_data['is_active'],
+            "name": key_data.name,
+            "is_active": key_data.is_active,
             "usage": {
-                "total_requests": key_data['total_requests'],
+                "total_requests": key_data.total_requests,
                 "daily_used": today_requests,
-                "daily_limit": key_data['daily_limit'],
-                "remaining_today": max(0, key_data['daily_limit'] - today_requests)
+                "daily_limit": key_data.daily_limit,
+                "remaining_today": max(0, key_data.daily_limit - today_requests)
             },
             "credits": {
-                "available": key_data['credits'],
+                "available": key_data.credits,
                 "total_used": total_credits_used
             },
-            "created_at": key_data['created_at'].isoformat(),
-            "last_used": key_data['last_used'].isoformat() if key_data['last_used'] else None
+            "created_at": key_data.created_at,
+            "last_used": key_data.last_used
         }
         
     except HTTPException:
@@ -186,24 +293,38 @@ async def text_generation(
     api_key: str = Query(..., description="Your API key")
 ):
     """Text generation using Pollinations.ai - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
-        # Call Pollinations.ai
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            pollinations_url = f"https://text.pollinations.ai/prompt/{prompt}"
+        validate_prompt(prompt)
+        
+        # Serve repeated prompts from the cache, otherwise call Pollinations.ai
+        cache_key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        cached = TEXT_CACHE.get(cache_key)
+        if cached and time.monotonic() - cached[0] < TEXT_CACHE_TTL:
+            ai_response = cached[1]
+        else:
+            client = app.state.http
+            pollinations_url = TEXT_URL + quote(prompt, safe='')
             response = await client.get(pollinations_url)
             response.raise_for_status()
             ai_response = response.text
             
+            TEXT_CACHE.pop(cache_key, None)
+            TEXT_CACHE[cache_key] = (time.monotonic(), ai_response)
+            if len(TEXT_CACHE) > TEXT_CACHE_MAX_SIZE:
+                TEXT_CACHE.pop(next(iter(TEXT_CACHE)))
+        
         # Update usage and log request (0 credits)
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        update_usage(api_key)
-        log_request(api_key, "/text", prompt, response_time, 0)
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/text", prompt, response_time, 0, now)
         
         # Return ONLY the AI response
         return ai_response
@@ -218,25 +339,32 @@ async def image_generation(
     prompt: str = Query(..., description="Image generation prompt"),
     api_key: str = Query(..., description="Your API key"),
     width: int = Query(512, description="Image width"),
-    height: int = Query(512, description="Image height")
+    height: int = Query(512, description="Image height"),
+    raw: bool = Query(False, description="Return the image URL instead of redirecting")
 ):
     """Image generation using Pollinations.ai - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
-        # Return direct image URL
-        direct_image_url = f"https://image.pollinations.ai/prompt/{prompt}?width={width}&height={height}&nologo=true"
+        validate_prompt(prompt)
+        
+        # Build direct image URL
+        direct_image_url = IMAGE_URL + quote(prompt, safe='') + "?width=" + str(width) + "&height=" + str(height) + "&nologo=true"
         
         # Update usage and log request (0 credits)
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        update_usage(api_key)
-        log_request(api_key, "/image", prompt, response_time, 0)
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/image", prompt, response_time, 0, now)
         
-        return direct_image_url
+        if raw:
+            return direct_image_url
+        return _cached_redirect(direct_image_url)
         
     except HTTPException:
         raise
@@ -247,25 +375,32 @@ async def image_generation(
 async def qr_generation(
     text: str = Query(..., description="Text to encode in QR code"),
     api_key: str = Query(..., description="Your API key"),
-    size: str = Query("150x150", description="QR code size")
+    size: str = Query("150x150", description="QR code size"),
+    raw: bool = Query(False, description="Return the QR code URL instead of redirecting")
 ):
     """QR code generation - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
-        # Return direct QR code URL
-        direct_qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size={size}&data={text}"
+        validate_prompt(text)
+        
+        # Build direct QR code URL
+        direct_qr_url = QR_URL + "?size=" + quote(size, safe='') + "&data=" + quote(text, safe='')
         
         # Update usage and log request (0 credits)
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        update_usage(api_key)
-        log_request(api_key, "/qr", text, response_time, 0)
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/qr", text, response_time, 0, now)
         
-        return direct_qr_url
+        if raw:
+            return direct_qr_url
+        return _cached_redirect(direct_qr_url)
         
     except HTTPException:
         raise
@@ -276,25 +411,32 @@ async def qr_generation(
 async def voice_generation(
     text: str = Query(..., description="Text to convert to speech"),
     api_key: str = Query(..., description="Your API key"),
-    voice: str = Query("alloy", description="Voice type")
+    voice: str = Query("alloy", description="Voice type"),
+    raw: bool = Query(False, description="Return the voice URL instead of redirecting")
 ):
     """Text-to-speech generation - FREE (0 credits)"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
-        # Return direct voice URL
-        voice_url = f"https://api.soundoftext.com/sounds/{text.lower().replace(' ', '+')}?voice={voice}"
+        validate_prompt(text)
+        
+        # Build direct voice URL
+        voice_url = f"{VOICE_URL}{quote_plus(text.lower())}?voice={quote(voice, safe='')}"
         
         # Update usage and log request (0 credits)
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        update_usage(api_key)
-        log_request(api_key, "/voice", text, response_time, 0)
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/voice", text, response_time, 0, now)
         
-        return voice_url
+        if raw:
+            return voice_url
+        return _cached_redirect(voice_url)
         
     except HTTPException:
         raise
@@ -308,29 +450,37 @@ async def number_service(
     api_key: str = Query(..., description="Your API key")
 ):
     """Number service - COST: 5 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
-        # Check if user has enough credits (5 credits needed)
-        if not check_credits(api_key, 5):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 5 credits.")
-        
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
+        if not _MOBILE_RE.fullmatch(mobile):
+            raise HTTPException(status_code=400, detail="Invalid mobile number")
+        
+        # Deduct credits up front (5 credits needed)
+        if not try_consume(key_data, 5):
+            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 5 credits.")
+        
         # Call number service API
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            num_url = f"https://nixonsmmapi.s77134867.workers.dev/?mobile={mobile}"
+        try:
+            client = app.state.http
+            num_url = NUM_URL + "?mobile=" + quote(mobile, safe='')
             response = await client.get(num_url)
             response.raise_for_status()
             num_response = response.text
-            
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 5)
-        update_usage(api_key)
-        log_request(api_key, "/num", mobile, response_time, 5)
+        except Exception:
+            refund_credits(key_data, 5)
+            raise
+        
+        # Log request
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/num", mobile, response_time, 5, now)
         
         return num_response
         
@@ -345,29 +495,33 @@ async def video_generation(
     api_key: str = Query(..., description="Your API key")
 ):
     """Video generation - COST: 2 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
     try:
-        # Check if user has enough credits (2 credits needed)
-        if not check_credits(api_key, 2):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 2 credits.")
-        
         # Validate API key
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=401, detail="Invalid API key")
         
+        # Deduct credits up front (2 credits needed)
+        if not try_consume(key_data, 2):
+            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 2 credits.")
+        
         # Call video generation API
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            video_url = f"https://api.yabes-desu.workers.dev/ai/tool/txt2video?prompt={prompt}"
-            response = await client.get(video_url)
+        try:
+            client = app.state.http
+            response = await client.get(VIDEO_URL, params={"prompt": prompt}, timeout=60.0)
             response.raise_for_status()
             video_response = response.json()
-            
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 2)
-        update_usage(api_key)
-        log_request(api_key, "/video", prompt, response_time, 2)
+        except Exception:
+            refund_credits(key_data, 2)
+            raise
+        
+        # Log request
+        now = datetime.now(timezone.utc)
+        response_time = time.perf_counter() - start_time
+        update_usage(key_data, now)
+        log_request(key_data, "/video", prompt, response_time, 2, now)
         
         # Process video response to match the desired format
         if isinstance(video_response, dict):
@@ -421,22 +575,19 @@ async def admin_generate_key(
             raise HTTPException(status_code=401, detail="Invalid admin credentials")
         
         new_key = generate_api_key()
-        expires_at = datetime.utcnow() + timedelta(days=365)
-        
-        API_KEYS_STORAGE[new_key] = {
-            'id': len(API_KEYS_STORAGE) + 1,
-            'key': new_key,
-            'name': key_name,
-            'created_at': datetime.utcnow(),
-            'is_active': True,
-            'total_requests': 0,
-            'daily_requests': 0,
-            'daily_limit': daily_limit,
-            'credits': initial_credits,
-            'last_reset': datetime.utcnow(),
-            'last_used': None,
-            'expires_at': expires_at
-        }
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(days=365)
+        
+        API_KEYS_STORAGE[new_key] = KeyRec(
+            id=next(_next_key_id),
+            key=new_key,
+            name=key_name,
+            created_at=now,
+            expires_at=expires_at,
+            daily_limit=daily_limit,
+            credits=initial_credits,
+            last_reset=now
+        )
         
         return {
             "success": True,
@@ -444,7 +595,7 @@ async def admin_generate_key(
             "key_name": key_name,
             "daily_limit": daily_limit,
             "initial_credits": initial_credits,
-            "expires_at": expires_at.isoformat()
+            "expires_at": expires_at
         }
         
     except HTTPException:
@@ -462,29 +613,23 @@ async def admin_list_keys(
         if not verify_admin(admin_username, admin_password):
             raise HTTPException(status_code=401, detail="Invalid admin credentials")
         
-        # Get today's usage from logs
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        today = datetime.now(timezone.utc).date()
         
         keys_with_stats = []
         for api_key, key_data in API_KEYS_STORAGE.items():
-            today_requests = sum(1 for log in REQUEST_LOGS_STORAGE 
-                               if log['api_key'] == api_key and log['created_at'] >= today_start)
-            
-            total_credits_used = sum(log['credits_used'] for log in REQUEST_LOGS_STORAGE if log['api_key'] == api_key)
-            
             keys_with_stats.append({
-                "id": key_data['id'],
-                "name": key_data['name'],
-                "key": key_data['key'],
-                "is_active": key_data['is_active'],
-                "total_requests": key_data['total_requests'],
-                "daily_used": today_requests,
-                "daily_limit": key_data['daily_limit'],
-                "credits_available": key_data['credits'],
-                "credits_used": total_credits_used,
-                "created_at": key_data['created_at'].isoformat(),
-                "last_used": key_data['last_used'].isoformat() if key_data['last_used'] else None,
-                "expires_at": key_data['expires_at'].isoformat()
+                "id": key_data.id,
+                "name": key_data.name,
+                "key": key_data.key,
+                "is_active": key_data.is_active,
+                "total_requests": key_data.total_requests,
+                "daily_used": get_today_count(key_data, today),
+                "daily_limit": key_data.daily_limit,
+                "credits_available": key_data.credits,
+                "credits_used": key_data.credits_used_total,
+                "created_at": key_data.created_at,
+                "last_used": key_data.last_used,
+                "expires_at": key_data.expires_at
             })
         
         return {
@@ -509,16 +654,16 @@ async def admin_add_credits(
         if not verify_admin(admin_username, admin_password):
             raise HTTPException(status_code=401, detail="Invalid admin credentials")
         
-        if api_key not in API_KEYS_STORAGE:
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
             raise HTTPException(status_code=404, detail="API key not found")
         
-        old_balance = API_KEYS_STORAGE[api_key]['credits']
-        API_KEYS_STORAGE[api_key]['credits'] += credits_to_add
+        key_data.credits += credits_to_add
         
         return {
             "success": True,
             "message": f"Added {credits_to_add} credits to key {api_key[:8]}...",
-            "new_credit_balance": API_KEYS_STORAGE[api_key]['credits']
+            "new_credit_balance": key_data.credits
         }
         
     except HTTPException:
@@ -538,22 +683,22 @@ async def admin_stats(
         
         # Basic stats
         total_keys = len(API_KEYS_STORAGE)
-        active_keys = sum(1 for key_data in API_KEYS_STORAGE.values() if key_data['is_active'])
-        total_requests = sum(key_data['total_requests'] for key_data in API_KEYS_STORAGE.values())
-        total_credits_used = sum(log['credits_used'] for log in REQUEST_LOGS_STORAGE)
+        active_keys = sum(1 for key_data in API_KEYS_STORAGE.values() if key_data.is_active)
+        total_requests = sum(key_data.total_requests for key_data in API_KEYS_STORAGE.values())
+        total_credits_used = sum(key_data.credits_used_total for key_data in API_KEYS_STORAGE.values())
         
         # Today's stats
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_requests = sum(1 for log in REQUEST_LOGS_STORAGE if log['created_at'] >= today_start)
+        today = datetime.now(timezone.utc).date()
+        today_requests = DAILY_REQUESTS.get(today, 0)
         
-        # Top users
-        from collections import defaultdict
-        user_requests = defaultdict(int)
-        for log in REQUEST_LOGS_STORAGE:
-            if log['created_at'] >= today_start:
-                user_requests[log['api_key']] += 1
+        # Top users, straight from the per-key daily counters
+        user_requests = (
+            (api_key, key_data.today_count)
+            for api_key, key_data in API_KEYS_STORAGE.items()
+            if key_data.today_date == today
+        )
         
-        top_users = sorted(user_requests.items(), key=lambda x: x[1], reverse=True)[:5]
+        top_users = nlargest(5, user_requests, key=itemgetter(1))
         
         return {
             "system_stats": {
@@ -574,17 +719,43 @@ async def admin_stats(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Stats error: {str(e)}")
 
+# Serialized /health body, rebuilt at most once per HEALTH_CACHE_SECONDS
+HEALTH_CACHE_SECONDS = 1.0
+_health_body = b''
+_health_built_at = float('-inf')
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy", 
-        "timestamp": datetime.utcnow().isoformat(),
-        "api_keys_count": len(API_KEYS_STORAGE),
-        "logs_count": len(REQUEST_LOGS_STORAGE)
-    }
+    global _health_body, _health_built_at
+    
+    now = time.monotonic()
+    if now - _health_built_at > HEALTH_CACHE_SECONDS:
+        _health_body = orjson.dumps({
+            "status": "healthy", 
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "api_keys_count": len(API_KEYS_STORAGE),
+            "logs_count": len(REQUEST_LOGS_STORAGE)
+        })
+        _health_built_at = now
+    
+    return Response(
+        content=_health_body,
+        media_type="application/json",
+        headers={"Cache-Control": "max-age=1"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # Each worker keeps its own in-memory storage, so keys minted by one
+    # worker are unknown to the others; WEB_CONCURRENCY defaults to 1
+    uvicorn.run(
+        "app_serverless:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        log_level="warning"
+    )
\ No newline at end of file